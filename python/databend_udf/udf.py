@@ -12,15 +12,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 import json
 import logging
+import importlib
 import inspect
-from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import re
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from itertools import repeat
 from typing import Iterator, Callable, Optional, Union, List, Dict
 
 import pyarrow as pa
+import pyarrow.compute as pc
 from pyarrow.flight import FlightServerBase, FlightInfo
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # comes from Databend
 MAX_DECIMAL128_PRECISION = 38
 MAX_DECIMAL256_PRECISION = 76
@@ -29,6 +43,12 @@ ARROW_EXT_TYPE_VARIANT = b"Variant"
 
 TIMESTAMP_UINT = "us"
 
+# batches smaller than this are not worth sending to worker processes
+PROCESS_POOL_MIN_ROWS = 256
+# rows converted to python objects at a time, large batches are split into chunks
+# of this size so the results are streamed back instead of being held all at once
+CHUNK_ROWS = 8192
+
 logger = logging.getLogger(__name__)
 
 
@@ -58,8 +78,15 @@ class ScalarFunction(UserDefinedFunction):
     _func: Callable
     _io_threads: Optional[int]
     _executor: Optional[ThreadPoolExecutor]
+    _workers: Optional[int]
+    _cpu_executor: Optional[ProcessPoolExecutor]
     _skip_null: bool
     _batch_mode: bool
+    _numpy_mode: bool
+    _arrow_mode: bool
+    _numba_mode: bool
+    _input_processors: List[Callable]
+    _output_processor: Callable
 
     def __init__(
         self,
@@ -70,28 +97,94 @@ class ScalarFunction(UserDefinedFunction):
         io_threads=None,
         skip_null=None,
         batch_mode=False,
+        numpy_mode=False,
+        arrow_mode=False,
+        workers=None,
     ):
         self._func = func
         self._input_schema = pa.schema(
             field.with_name(arg_name)
             for arg_name, field in zip(
-                inspect.getfullargspec(func)[0],
+                _arg_names(func),
                 [_to_arrow_field(t) for t in _to_list(input_types)],
             )
         )
         self._result_schema = pa.schema(
             [_to_arrow_field(result_type).with_name("output")]
         )
-        self._name = name or (
-            func.__name__ if hasattr(func, "__name__") else func.__class__.__name__
-        )
+        # the processors of a single value only depend on the schema, build them once
+        self._input_processors = [
+            _input_process_func(field) for field in self._input_schema
+        ]
+        self._output_processor = _output_process_func(self._result_schema.field(0))
+        self._name = name or getattr(func, "__name__", func.__class__.__name__)
         self._io_threads = io_threads
-        self._batch_mode = batch_mode
+        # numpy mode is batch mode with numpy arrays instead of lists
+        self._batch_mode = batch_mode or numpy_mode
+        self._numpy_mode = numpy_mode
+        self._arrow_mode = arrow_mode
+        if arrow_mode and (
+            skip_null
+            or self._batch_mode
+            or io_threads is not None
+            or workers is not None
+        ):
+            raise ValueError(
+                f"Function {self._name} can not set skip_null, batch_mode, numpy_mode, "
+                "io_threads or workers when arrow_mode is True"
+            )
+        if numpy_mode and not all(
+            _field_is_numeric(field) for field in self._input_schema
+        ):
+            raise ValueError(
+                f"Input types of function {self._name} must be integers or floats "
+                "when numpy_mode is True"
+            )
+        if workers is not None and workers < 1:
+            raise ValueError(
+                f"Number of workers of function {self._name} must be at least 1"
+            )
+        if workers is not None and self._batch_mode:
+            raise ValueError(
+                f"Function {self._name} can not set workers "
+                "when batch_mode or numpy_mode is True"
+            )
+        # numba compiled functions are applied on whole numpy arrays
+        self._numba_mode = (
+            _is_numba_func(func)
+            and not self._batch_mode
+            and not arrow_mode
+            and len(self._input_schema) > 0
+            and all(_field_is_numeric(field) for field in self._input_schema)
+            and _field_is_numeric(self._result_schema.field(0))
+        )
+        self._numba_driver = None
+        if self._numba_mode:
+            self._numba_mode = self._compile_numba()
+        if self._numba_mode and workers is not None:
+            raise ValueError(
+                f"Function {self._name} is applied on arrays by numba "
+                "and can not set workers"
+            )
         self._executor = (
-            ThreadPoolExecutor(max_workers=self._io_threads)
+            ThreadPoolExecutor(
+                max_workers=self._io_threads, thread_name_prefix=f"udf-{self._name}"
+            )
             if self._io_threads is not None
             else None
         )
+        self._workers = workers
+        if self._workers is not None:
+            qualname = getattr(func, "__qualname__", "")
+            if not qualname or "<" in qualname:
+                raise ValueError(
+                    f"Function {self._name} must be defined at module level when workers is set"
+                )
+            # worker processes look the function up by name instead of pickling it
+            self._func_ref = (func.__module__, qualname)
+        # the process pool is created on first use, see `_get_cpu_executor`
+        self._cpu_executor = None
+        self._cpu_executor_lock = threading.Lock()
 
         if skip_null and not self._result_schema.field(0).nullable:
             raise ValueError(
@@ -99,48 +192,195 @@ class ScalarFunction(UserDefinedFunction):
             )
 
         self._skip_null = skip_null or False
+        # rows evaluated in the calling thread go through one generated loop
+        if not self._batch_mode and self._executor is None:
+            self._row_driver = _row_driver(
+                func, self._input_processors, self._output_processor, False
+            )
+            self._masked_row_driver = (
+                _row_driver(func, self._input_processors, self._output_processor, True)
+                if self._skip_null
+                else None
+            )
+        else:
+            self._row_driver = None
         super().__init__()
 
     def eval_batch(self, batch: pa.RecordBatch) -> Iterator[pa.RecordBatch]:
-        inputs = [[v.as_py() for v in array] for array in batch]
-        inputs = [
-            _input_process_func(_list_field(field))(array)
-            for array, field in zip(inputs, self._input_schema)
-        ]
+        if self._arrow_mode:
+            # the function consumes and produces arrow arrays directly
+            array = _to_arrow_array(
+                self._func(*batch.columns), self._result_schema.types[0]
+            )
+            if len(array) != batch.num_rows:
+                raise ValueError(
+                    f"Function {self._name} returned {len(array)} rows, "
+                    f"expected {batch.num_rows}"
+                )
+            yield pa.RecordBatch.from_arrays([array], schema=self._result_schema)
+            return
+
+        if self._numba_mode and not any(array.null_count for array in batch.columns):
+            arrays = [array.to_numpy(zero_copy_only=True) for array in batch.columns]
+            array = _to_arrow_array(
+                self._eval_numba(arrays), self._result_schema.types[0]
+            )
+            yield pa.RecordBatch.from_arrays([array], schema=self._result_schema)
+            return
+
+        # an empty batch still produces one empty output batch
+        for offset in range(0, max(batch.num_rows, 1), CHUNK_ROWS):
+            yield self._eval_chunk(batch.slice(offset, CHUNK_ROWS))
+
+    def _eval_chunk(self, batch: pa.RecordBatch) -> pa.RecordBatch:
+        """
+        Evaluate the function on a chunk of rows converted to python objects.
+        """
+        if self._row_driver is not None and (
+            self._workers is None or batch.num_rows < PROCESS_POOL_MIN_ROWS
+        ):
+            columns = [array.to_pylist() for array in batch.columns]
+            # rows with any NULL argument, None if there is no such row
+            null_mask = _null_mask(batch) if self._skip_null else None
+            if null_mask is not None:
+                column = self._masked_row_driver(batch.num_rows, null_mask, *columns)
+            else:
+                column = self._row_driver(batch.num_rows, *columns)
+            array = _to_arrow_array(column, self._result_schema.types[0])
+            return pa.RecordBatch.from_arrays([array], schema=self._result_schema)
+
+        inputs = []
+        for array, func in zip(batch.columns, self._input_processors):
+            if self._numpy_mode:
+                inputs.append(_to_numpy(array))
+            elif func is _identity:
+                inputs.append(array.to_pylist())
+            else:
+                inputs.append(
+                    [func(v) if v is not None else None for v in array.to_pylist()]
+                )
 
         # evaluate the function for each row
         if self._batch_mode:
             column = self._func(*inputs)
-        elif self._executor is not None:
-            # concurrently evaluate the function for each row
-            if self._skip_null:
-                tasks = []
-                for row in range(batch.num_rows):
-                    args = [col[row] for col in inputs]
-                    func = _null_func if None in args else self._func
-                    tasks.append(self._executor.submit(func, *args))
-            else:
-                tasks = [
-                    self._executor.submit(self._func, *[col[row] for col in inputs])
-                    for row in range(batch.num_rows)
-                ]
-            column = [future.result() for future in tasks]
         else:
-            if self._skip_null:
-                column = []
-                for row in range(batch.num_rows):
-                    args = [col[row] for col in inputs]
-                    column.append(None if None in args else self._func(*args))
+            # zip() builds the argument tuple of each row in C,
+            # a function without arguments still needs one call per row
+            rows = zip(*inputs) if inputs else [()] * batch.num_rows
+            # rows with any NULL argument, None if there is no such row
+            null_mask = _null_mask(batch) if self._skip_null else None
+            if self._workers is not None and batch.num_rows >= PROCESS_POOL_MIN_ROWS:
+                # evaluate the rows in worker processes, one chunk per worker
+                rows = list(rows)
+                size = -(-len(rows) // self._workers)
+                offsets = range(0, len(rows), size)
+                executor = self._get_cpu_executor()
+                try:
+                    results = executor.map(
+                        _apply_chunk,
+                        repeat(self._func_ref),
+                        [rows[i : i + size] for i in offsets],
+                        [null_mask[i : i + size] for i in offsets]
+                        if null_mask is not None
+                        else repeat(None),
+                    )
+                    column = [v for chunk in results for v in chunk]
+                except BrokenProcessPool:
+                    # a worker died, the next batch starts a new pool
+                    self._reset_cpu_executor(executor)
+                    raise
             else:
-                column = [
-                    self._func(*[col[row] for col in inputs])
-                    for row in range(batch.num_rows)
-                ]
+                # concurrently evaluate the function for each row
+                if null_mask is not None:
+                    tasks = [
+                        self._executor.submit(
+                            _null_func if is_null else self._func, *args
+                        )
+                        for is_null, args in zip(null_mask, rows)
+                    ]
+                else:
+                    tasks = [self._executor.submit(self._func, *args) for args in rows]
+                column = [future.result() for future in tasks]
+
+        # a batch mode function may also return an arrow array
+        if self._output_processor is not _identity and not isinstance(
+            column, (pa.Array, pa.ChunkedArray)
+        ):
+            func = self._output_processor
+            column = [func(v) if v is not None else None for v in column]
+
+        array = _to_arrow_array(column, self._result_schema.types[0])
+        return pa.RecordBatch.from_arrays([array], schema=self._result_schema)
+
+    def _eval_numba(self, arrays: list):
+        """
+        Call the numba function on the numpy arrays of the arguments.
+        """
+        if self._numba_driver is not None:
+            try:
+                return self._numba_driver(*arrays)
+            except SystemError as e:
+                # an error raised in a parallel loop is wrapped by numba,
+                # raise the error of the function instead
+                if e.__cause__ is None:
+                    raise
+                raise e.__cause__ from None
+        return self._func(*arrays)
+
+    def _compile_numba(self) -> bool:
+        """
+        Check whether the numba function can be applied on arrays.
+
+        The function is called on empty arrays of the argument types, which
+        compiles it without evaluating any row. If it can not be applied on
+        arrays, the rows are evaluated one by one instead.
+        """
+        from numba.core.errors import NumbaError
+
+        # the same read-only views as the ones of an input batch
+        arrays = [
+            pa.array([], type=field.type).to_numpy(zero_copy_only=True)
+            for field in self._input_schema
+        ]
+        try:
+            # a jitted scalar kernel is called for each row in a compiled loop,
+            # numba ufuncs already broadcast over arrays
+            if hasattr(self._func, "py_func"):
+                self._numba_driver = _numba_driver(
+                    self._func, [array.dtype for array in arrays]
+                )
+            column = self._eval_numba(arrays)
+            compiled = getattr(column, "shape", None) == (0,)
+        except (NumbaError, TypeError, ValueError):
+            compiled = False
+        if not compiled:
+            logger.info(
+                f"function {self._name} can not be applied on arrays, "
+                "it is evaluated row by row"
+            )
+            self._numba_driver = None
+        return compiled
 
-        column = _output_process_func(_list_field(self._result_schema.field(0)))(column)
+    def _get_cpu_executor(self) -> ProcessPoolExecutor:
+        """
+        Return the process pool, create it on first use.
 
-        array = pa.array(column, type=self._result_schema.types[0])
-        yield pa.RecordBatch.from_arrays([array], schema=self._result_schema)
+        The pool is created while the server is handling requests, forking the
+        server process then would copy the state of its running threads, so the
+        workers are started by a fork server or spawned instead.
+        """
+        with self._cpu_executor_lock:
+            if self._cpu_executor is None:
+                self._cpu_executor = ProcessPoolExecutor(
+                    max_workers=self._workers, mp_context=_worker_context()
+                )
+            return self._cpu_executor
+
+    def _reset_cpu_executor(self, executor: ProcessPoolExecutor):
+        with self._cpu_executor_lock:
+            if self._cpu_executor is executor:
+                self._cpu_executor = None
+        executor.shutdown(wait=False)
 
     def __call__(self, *args):
         return self._func(*args)
@@ -150,9 +390,12 @@ def udf(
     input_types: Union[List[Union[str, pa.DataType]], Union[str, pa.DataType]],
     result_type: Union[str, pa.DataType],
     name: Optional[str] = None,
-    io_threads: Optional[int] = 32,
+    io_threads: Optional[int] = None,
     skip_null: Optional[bool] = False,
     batch_mode: Optional[bool] = False,
+    numpy_mode: Optional[bool] = False,
+    arrow_mode: Optional[bool] = False,
+    workers: Optional[int] = None,
 ) -> Callable:
     """
     Annotation for creating a user-defined scalar function.
@@ -163,10 +406,32 @@ def udf(
     - name: An optional string specifying the function name.
             If not provided, the original name will be used.
     - io_threads: Number of I/O threads used per data chunk for I/O bound functions.
+                Default to None, which evaluates rows in the calling thread.
     - skip_null: A boolean value specifying whether to skip NULL value. If it is set to True,
                 NULL values will not be passed to the function,
                 and the corresponding return value is set to NULL. Default to False.
-    - batch_mode: A boolean value specifying whether to use batch mode. Default to False.
+    - batch_mode: A boolean value specifying whether to use batch mode.
+                In batch mode, each argument is passed as a list of values.
+                The function is called once per chunk of at most `CHUNK_ROWS` rows,
+                not once per input batch.
+                The function may return a list, a numpy array or a pyarrow array.
+                Default to False.
+    - numpy_mode: A boolean value specifying whether to use batch mode with numpy arrays.
+                Each argument is passed as a numpy array, a read-only view on the arrow
+                buffer, or a `numpy.ma.MaskedArray` if the column has NULL values.
+                It is called once per chunk like in batch mode.
+                All input types must be integers or floats. Default to False.
+    - arrow_mode: A boolean value specifying whether to pass `pyarrow.Array` columns
+                to the function and take a `pyarrow.Array` back, without converting
+                values to Python objects. The returned array must have one value per row,
+                and it can not be combined with skip_null, batch_mode, io_threads
+                or workers. Default to False.
+    - workers: Number of worker processes used per data chunk for CPU bound functions.
+                Only batches of at least `PROCESS_POOL_MIN_ROWS` rows are sent to the workers.
+                The function must be defined at module level, and the server must be
+                started under `if __name__ == '__main__':` as the workers import the
+                main module again. It can not be combined with batch_mode, numpy_mode,
+                arrow_mode or a numba function applied on arrays. Default to None.
 
     Example:
     ```
@@ -185,12 +450,33 @@ def udf(
         return response["data"]
     ```
 
+    CPU bound Example:
+    ```
+    @udf(input_types=['BIGINT'], result_type='BIGINT', workers=8)
+    def fib(n):
+        return n if n < 2 else fib(n - 1) + fib(n - 2)
+    ```
+
     Batch mode example:
     ```
     @udf(input_types=['INT', 'INT'], result_type='INT', batch_mode=True)
     def gcd(x, y):
         return [x_i if y_i == 0 else gcd(y_i, x_i % y_i) for x_i, y_i in zip(x, y)]
     ```
+
+    Numpy mode example:
+    ```
+    @udf(input_types=['DOUBLE', 'DOUBLE'], result_type='DOUBLE', numpy_mode=True)
+    def hypot(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        return np.hypot(x, y)
+    ```
+
+    Arrow mode example:
+    ```
+    @udf(input_types=['BIGINT', 'BIGINT'], result_type='BIGINT', arrow_mode=True)
+    def multiply(x: pa.Array, y: pa.Array) -> pa.Array:
+        return pyarrow.compute.multiply(x, y)
+    ```
     """
 
     if io_threads is not None and io_threads > 1:
@@ -202,6 +488,9 @@ def udf(
             io_threads=io_threads,
             skip_null=skip_null,
             batch_mode=batch_mode,
+            numpy_mode=numpy_mode,
+            arrow_mode=arrow_mode,
+            workers=workers,
         )
     else:
         return lambda f: ScalarFunction(
@@ -211,6 +500,9 @@ def udf(
             name,
             skip_null=skip_null,
             batch_mode=batch_mode,
+            numpy_mode=numpy_mode,
+            arrow_mode=arrow_mode,
+            workers=workers,
         )
 
 
@@ -224,12 +516,21 @@ class UDFServer(FlightServerBase):
     server.add_function(my_udf)
     server.serve()
     ```
+
+    Parameters:
+    - location: The address the server listens on.
+    - memory_pool: The arrow memory pool used by the process, either a
+                `pyarrow.MemoryPool` or the name of a backend: "jemalloc",
+                "mimalloc" or "system". None keeps the pyarrow default.
+                Default to "jemalloc", which falls back to the pyarrow default
+                if pyarrow is built without it.
     """
 
     _location: str
     _functions: Dict[str, UserDefinedFunction]
 
-    def __init__(self, location="0.0.0.0:8815", **kwargs):
+    def __init__(self, location="0.0.0.0:8815", memory_pool="jemalloc", **kwargs):
+        _set_memory_pool(memory_pool)
         super(UDFServer, self).__init__("grpc://" + location, **kwargs)
         self._location = location
         self._functions = {}
@@ -246,8 +547,9 @@ class UDFServer(FlightServerBase):
             schema=full_schema,
             descriptor=descriptor,
             endpoints=[],
-            total_records=len(full_schema),
-            total_bytes=0,
+            # the size of the results is unknown until the function is called
+            total_records=-1,
+            total_bytes=-1,
         )
 
     def do_exchange(self, context, descriptor, reader, writer):
@@ -288,6 +590,21 @@ class UDFServer(FlightServerBase):
         super(UDFServer, self).serve()
 
 
+def _set_memory_pool(pool: Union[str, pa.MemoryPool, None]):
+    """
+    Set the default arrow memory pool of the process.
+    """
+    if isinstance(pool, str):
+        try:
+            pool = getattr(pa, f"{pool}_memory_pool")()
+        except (AttributeError, NotImplementedError) as e:
+            logger.warning(f"memory pool {pool} is not available: {e}")
+            pool = None
+    if pool is not None:
+        pa.set_memory_pool(pool)
+    logger.info(f"arrow memory pool: {pa.default_memory_pool().backend_name}")
+
+
 def _input_process_func(field: pa.Field) -> Callable:
     """
     Return a function to process input value.
@@ -295,9 +612,13 @@ def _input_process_func(field: pa.Field) -> Callable:
     - Tuple=pa.struct(): dict -> tuple
     - Json=pa.large_binary(): bytes -> Any
     - Map=pa.map_(): list[tuple(k,v)] -> dict
+
+    Return `_identity` if the value needs no conversion.
     """
     if pa.types.is_list(field.type):
         func = _input_process_func(field.type.value_field)
+        if func is _identity:
+            return _identity
         return (
             lambda array: [func(v) if v is not None else None for v in array]
             if array is not None
@@ -307,6 +628,8 @@ def _input_process_func(field: pa.Field) -> Callable:
         funcs = [_input_process_func(f) for f in field.type]
         # the input value of struct type is a dict
         # we convert it into tuple here
+        if all(func is _identity for func in funcs):
+            return lambda map: tuple(map.values()) if map is not None else None
         return (
             lambda map: tuple(
                 func(v) if v is not None else None
@@ -321,6 +644,8 @@ def _input_process_func(field: pa.Field) -> Callable:
             _input_process_func(field.type.item_field),
         ]
         # list[tuple[k,v]] -> dict
+        if all(func is _identity for func in funcs):
+            return lambda array: dict(array) if array is not None else None
         return (
             lambda array: dict(
                 tuple(func(v) for v, func in zip(item, funcs)) for item in array
@@ -330,20 +655,24 @@ def _input_process_func(field: pa.Field) -> Callable:
         )
     if pa.types.is_large_binary(field.type):
         if _field_is_variant(field):
-            return lambda v: json.loads(v) if v is not None else None
+            return lambda v: _json_loads(v) if v is not None else None
 
-    return lambda v: v
+    return _identity
 
 
 def _output_process_func(field: pa.Field) -> Callable:
     """
     Return a function to process output value.
 
-    - Json=pa.large_binary(): Any -> str
+    - Json=pa.large_binary(): Any -> bytes
     - Map=pa.map_(): dict -> list[tuple(k,v)]
+
+    Return `_identity` if the value needs no conversion.
     """
     if pa.types.is_list(field.type):
         func = _output_process_func(field.type.value_field)
+        if func is _identity:
+            return _identity
         return (
             lambda array: [func(v) if v is not None else None for v in array]
             if array is not None
@@ -351,6 +680,8 @@ def _output_process_func(field: pa.Field) -> Callable:
         )
     if pa.types.is_struct(field.type):
         funcs = [_output_process_func(f) for f in field.type]
+        if all(func is _identity for func in funcs):
+            return lambda tup: tuple(tup) if tup is not None else None
         return (
             lambda tup: tuple(
                 func(v) if v is not None else None for v, func in zip(tup, funcs)
@@ -364,6 +695,8 @@ def _output_process_func(field: pa.Field) -> Callable:
             _output_process_func(field.type.item_field),
         ]
         # dict -> list[tuple[k,v]]
+        if all(func is _identity for func in funcs):
+            return lambda map: list(map.items()) if map is not None else None
         return (
             lambda map: [
                 tuple(func(v) for v, func in zip(item, funcs)) for item in map.items()
@@ -373,17 +706,156 @@ def _output_process_func(field: pa.Field) -> Callable:
         )
     if pa.types.is_large_binary(field.type):
         if _field_is_variant(field):
-            return lambda v: json.dumps(_ensure_str(v)) if v is not None else None
+            return lambda v: _json_dumps(v) if v is not None else None
 
-    return lambda v: v
+    return _identity
 
 
-def _null_func(*args):
-    return None
+def _row_driver(
+    func: Callable, input_funcs: List[Callable], output_func: Callable, masked: bool
+) -> Callable:
+    """
+    Generate a function that evaluates `func` on each row of the input columns.
+
+    The input processing, the call and the output processing are fused into a
+    single loop, and `_identity` processors are left out of the generated code:
+
+    ```
+    def driver(num_rows, c0, c1):
+        column = []
+        append = column.append
+        for a0, a1 in zip(c0, c1):
+            r = func(p0(a0) if a0 is not None else None, a1)
+            append(output(r) if r is not None else None)
+        return column
+    ```
+
+    If `masked` is True, the driver takes a NULL mask before the columns,
+    masked rows return NULL and the other rows have no NULL argument.
+    """
+    namespace = {"func": func, "output": output_func}
+    columns = [f"c{i}" for i in range(len(input_funcs))]
+    names = [f"a{i}" for i in range(len(input_funcs))]
+    args = []
+    for i, (name, input_func) in enumerate(zip(names, input_funcs)):
+        if input_func is _identity:
+            args.append(name)
+        elif masked:
+            namespace[f"p{i}"] = input_func
+            args.append(f"p{i}({name})")
+        else:
+            namespace[f"p{i}"] = input_func
+            args.append(f"p{i}({name}) if {name} is not None else None")
+
+    if masked:
+        columns.insert(0, "mask")
+        names.insert(0, "is_null")
+    if not names:
+        loop = "for _ in range(num_rows):"
+    elif len(names) == 1:
+        loop = f"for {names[0]} in {columns[0]}:"
+    else:
+        loop = f"for {', '.join(names)} in zip({', '.join(columns)}):"
+
+    call = f"func({', '.join(args)})"
+    lines = [
+        f"def driver({', '.join(['num_rows'] + columns)}):",
+        "    column = []",
+        "    append = column.append",
+        f"    {loop}",
+    ]
+    if masked:
+        lines += [
+            "        if is_null:",
+            "            append(None)",
+            "            continue",
+        ]
+    if output_func is _identity:
+        lines.append(f"        append({call})")
+    else:
+        lines += [
+            f"        r = {call}",
+            "        append(output(r) if r is not None else None)",
+        ]
+    lines.append("    return column")
+    exec("\n".join(lines), namespace)
+    return namespace["driver"]
+
+
+def _worker_context():
+    """
+    Return the multiprocessing context used to start worker processes.
+    """
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def _apply_chunk(func_ref, rows, null_mask):
+    """
+    Evaluate a function on a chunk of rows in a worker process.
+    """
+    module, qualname = func_ref
+    func = importlib.import_module(module)
+    for attr in qualname.split("."):
+        func = getattr(func, attr)
+    if null_mask is not None:
+        return [
+            None if is_null else func(*args) for is_null, args in zip(null_mask, rows)
+        ]
+    return [func(*args) for args in rows]
+
+
+def _null_mask(batch: pa.RecordBatch) -> Optional[List[bool]]:
+    """
+    Return whether each row has a NULL value, or None if no row has one.
+    """
+    mask = None
+    for array in batch.columns:
+        if array.null_count:
+            is_null = array.is_null()
+            mask = is_null if mask is None else pc.or_(mask, is_null)
+    return mask.to_pylist() if mask is not None else None
+
+
+def _to_arrow_array(column, type: pa.DataType) -> pa.Array:
+    """
+    Convert the return values of a function to an arrow array.
+
+    - pa.Array: cast to the type if needed
+    - np.ndarray: converted without copy if the dtype matches
+    - list: converted by the typed `pa.array` path
+    """
+    if isinstance(column, pa.ChunkedArray):
+        column = column.combine_chunks()
+    if isinstance(column, pa.Array):
+        return column if column.type == type else column.cast(type)
+    return pa.array(column, type=type)
+
+
+def _to_numpy(array: pa.Array):
+    """
+    Convert an integer or float array to a numpy array of the same dtype.
+
+    NULL values are masked in a `numpy.ma.MaskedArray`.
+    """
+    if array.null_count == 0:
+        # a read-only view on the arrow buffer, no value is copied
+        return array.to_numpy(zero_copy_only=True)
+    import numpy as np
+
+    return np.ma.masked_array(
+        array.fill_null(0).to_numpy(zero_copy_only=True),
+        mask=array.is_null().to_numpy(zero_copy_only=False),
+    )
+
+
+def _identity(v):
+    return v
 
 
-def _list_field(field: pa.Field) -> pa.Field:
-    return pa.field("", pa.list_(field))
+def _null_func(*args):
+    return None
 
 
 def _to_list(x):
@@ -393,6 +865,44 @@ def _to_list(x):
         return [x]
 
 
+def _json_dumps_stdlib(v) -> bytes:
+    return json.dumps(_ensure_str(v)).encode()
+
+
+def _json_loads_orjson(v):
+    if _LONG_DIGITS.search(v):
+        # orjson parses integers wider than 64 bits as floats, keep them exact
+        return json.loads(v)
+    return orjson.loads(v)
+
+
+# 20 digits or more, longer than any 64 bits integer except some unsigned ones
+_LONG_DIGITS = re.compile(rb"\d{20}")
+
+
+def _json_dumps_orjson(v) -> bytes:
+    try:
+        return orjson.dumps(v, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    except TypeError:
+        # e.g. bytes dict keys or integers wider than 64 bits
+        return _json_dumps_stdlib(v)
+
+
+def _json_default(v):
+    if isinstance(v, bytes):
+        return v.decode("utf-8")
+    raise TypeError(f"Type is not JSON serializable: {type(v).__name__}")
+
+
+# both directions work on utf-8 bytes, which is what the binary column stores
+if orjson is not None:
+    _json_loads = _json_loads_orjson
+    _json_dumps = _json_dumps_orjson
+else:
+    _json_loads = json.loads
+    _json_dumps = _json_dumps_stdlib
+
+
 def _ensure_str(x):
     if isinstance(x, bytes):
         return x.decode("utf-8")
@@ -412,6 +922,113 @@ def _field_is_variant(field: pa.Field) -> bool:
     return False
 
 
+def _field_is_numeric(field: pa.Field) -> bool:
+    return pa.types.is_integer(field.type) or pa.types.is_floating(field.type)
+
+
+def _is_numba_func(func) -> bool:
+    # numba dispatchers and ufuncs, checked without importing numba
+    return type(func).__module__.startswith("numba.")
+
+
+# argument names by function, a reloaded function is dropped with its module
+_ARG_NAMES: "weakref.WeakKeyDictionary[Callable, List[str]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _arg_names(func) -> List[str]:
+    """
+    Return the argument names of a function.
+    """
+    try:
+        names = _ARG_NAMES.get(func)
+    except TypeError:
+        # callable objects that are unhashable or can not be weakly referenced
+        return inspect.getfullargspec(_python_func(func)).args
+    if names is None:
+        # getfullargspec builds a full signature, do it once per function
+        names = _ARG_NAMES[func] = inspect.getfullargspec(_python_func(func)).args
+    return names
+
+
+def _numba_thread_safe() -> bool:
+    """
+    Return whether numba runs parallel loops on a thread-safe threading layer.
+
+    The layer is chosen by the first parallel loop of the process,
+    an empty one is run if there was none yet.
+    """
+    import numba
+    import numpy as np
+
+    try:
+        return numba.threading_layer() != "workqueue"
+    except ValueError:
+        pass
+
+    @numba.njit(parallel=True)
+    def init(out):
+        for i in numba.prange(len(out)):
+            out[i] = i
+
+    init(np.empty(0))
+    return numba.threading_layer() != "workqueue"
+
+
+def _numba_driver(func, dtypes: list) -> Callable:
+    """
+    Generate a function that applies a jitted scalar function on numpy arrays.
+
+    The loop runs without holding the GIL. With a thread-safe threading layer
+    (tbb or omp) it is compiled with `parallel=True`, so the rows are split
+    across threads. Numba's workqueue layer aborts the process if two parallel
+    loops run at once and loses the errors raised in them, so the loop is
+    compiled serially on it.
+
+    The results are stored with the dtype numba infers for `func`, not the
+    return type of the UDF, so a value that does not fit the return type is
+    rejected when it is converted to arrow instead of wrapping around.
+    """
+    import numba
+    import numpy as np
+    from numba.np.numpy_support import as_dtype
+
+    arg_types = tuple(numba.from_dtype(dtype) for dtype in dtypes)
+    signature = func.typingctx.resolve_function_type(numba.typeof(func), arg_types, {})
+    if signature is None:
+        raise TypeError(f"no matching definition for argument types {arg_types}")
+    dtype = as_dtype(signature.return_type)
+
+    args = ", ".join(f"c{i}" for i in range(len(dtypes)))
+    items = ", ".join(f"c{i}[i]" for i in range(len(dtypes)))
+    source = (
+        f"def driver(out, {args}):\n"
+        f"    for i in prange(len(out)):\n"
+        f"        out[i] = func({items})\n"
+    )
+    namespace = {"func": func, "prange": numba.prange}
+    exec(source, namespace)
+    # prange is a plain range in a serial loop
+    driver = numba.njit(parallel=_numba_thread_safe(), nogil=True)(namespace["driver"])
+
+    def apply(*arrays):
+        out = np.empty(len(arrays[0]), dtype=dtype)
+        driver(out, *arrays)
+        return out
+
+    return apply
+
+
+def _python_func(func):
+    """
+    Return the original python function of a numba function.
+    """
+    if _is_numba_func(func):
+        return getattr(func, "py_func", None) or getattr(func, "__wrapped__", func)
+    return func
+
+
 def _to_arrow_field(t: Union[str, pa.DataType]) -> pa.Field:
     """
     Convert a string or pyarrow.DataType to pyarrow.Field.
@@ -437,38 +1054,60 @@ def _type_str_to_arrow_field(type_str: str) -> pa.Field:
     return _type_str_to_arrow_field_inner(type_str).with_nullable(nullable)
 
 
+# SQL types without parameters and their arrow types
+_SIMPLE_TYPES = {
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "TINYINT": pa.int8(),
+    "INT8": pa.int8(),
+    "SMALLINT": pa.int16(),
+    "INT16": pa.int16(),
+    "INT": pa.int32(),
+    "INTEGER": pa.int32(),
+    "INT32": pa.int32(),
+    "BIGINT": pa.int64(),
+    "INT64": pa.int64(),
+    "TINYINT UNSIGNED": pa.uint8(),
+    "UINT8": pa.uint8(),
+    "SMALLINT UNSIGNED": pa.uint16(),
+    "UINT16": pa.uint16(),
+    "INT UNSIGNED": pa.uint32(),
+    "INTEGER UNSIGNED": pa.uint32(),
+    "UINT32": pa.uint32(),
+    "BIGINT UNSIGNED": pa.uint64(),
+    "UINT64": pa.uint64(),
+    "FLOAT": pa.float32(),
+    "FLOAT32": pa.float32(),
+    "FLOAT64": pa.float64(),
+    "DOUBLE": pa.float64(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp(TIMESTAMP_UINT),
+    "TIMESTAMP": pa.timestamp(TIMESTAMP_UINT),
+    "STRING": pa.large_utf8(),
+    "VARCHAR": pa.large_utf8(),
+    "CHAR": pa.large_utf8(),
+    "CHARACTER": pa.large_utf8(),
+    "TEXT": pa.large_utf8(),
+    "BINARY": pa.large_binary(),
+}
+
+
+# parsed type strings, `pa.Field` is immutable so the same object can be shared
+_FIELD_CACHE: Dict[str, pa.Field] = {}
+
+
 def _type_str_to_arrow_field_inner(type_str: str) -> pa.Field:
     type_str = type_str.strip().upper()
-    if type_str in ("BOOLEAN", "BOOL"):
-        return pa.field("", pa.bool_(), False)
-    elif type_str in ("TINYINT", "INT8"):
-        return pa.field("", pa.int8(), False)
-    elif type_str in ("SMALLINT", "INT16"):
-        return pa.field("", pa.int16(), False)
-    elif type_str in ("INT", "INTEGER", "INT32"):
-        return pa.field("", pa.int32(), False)
-    elif type_str in ("BIGINT", "INT64"):
-        return pa.field("", pa.int64(), False)
-    elif type_str in ("TINYINT UNSIGNED", "UINT8"):
-        return pa.field("", pa.uint8(), False)
-    elif type_str in ("SMALLINT UNSIGNED", "UINT16"):
-        return pa.field("", pa.uint16(), False)
-    elif type_str in ("INT UNSIGNED", "INTEGER UNSIGNED", "UINT32"):
-        return pa.field("", pa.uint32(), False)
-    elif type_str in ("BIGINT UNSIGNED", "UINT64"):
-        return pa.field("", pa.uint64(), False)
-    elif type_str in ("FLOAT", "FLOAT32"):
-        return pa.field("", pa.float32(), False)
-    elif type_str in ("FLOAT64", "DOUBLE"):
-        return pa.field("", pa.float64(), False)
-    elif type_str == "DATE":
-        return pa.field("", pa.date32(), False)
-    elif type_str in ("DATETIME", "TIMESTAMP"):
-        return pa.field("", pa.timestamp(TIMESTAMP_UINT), False)
-    elif type_str in ("STRING", "VARCHAR", "CHAR", "CHARACTER", "TEXT"):
-        return pa.field("", pa.large_utf8(), False)
-    elif type_str in ("BINARY"):
-        return pa.field("", pa.large_binary(), False)
+    field = _FIELD_CACHE.get(type_str)
+    if field is None:
+        field = _FIELD_CACHE[type_str] = _parse_type_str(type_str)
+    return field
+
+
+def _parse_type_str(type_str: str) -> pa.Field:
+    t = _SIMPLE_TYPES.get(type_str)
+    if t is not None:
+        return pa.field("", t, False)
     elif type_str in ("VARIANT", "JSON"):
         # In Databend, JSON type is identified by the "EXTENSION" key in the metadata.
         return pa.field(
@@ -542,6 +1181,21 @@ def _field_type_to_string(field: pa.Field) -> str:
     Convert a `pyarrow.DataType` to a SQL data type string.
     """
     t = field.type
+    if pa.types.is_list(t):
+        return f"ARRAY({_inner_field_to_string(t.value_field)})"
+    elif pa.types.is_map(t):
+        return f"MAP({_inner_field_to_string(t.key_field)}, {_inner_field_to_string(t.item_field)})"
+    elif pa.types.is_struct(t):
+        args_str = ", ".join(_inner_field_to_string(field) for field in t)
+        return f"TUPLE({args_str})"
+    else:
+        return _scalar_type_to_string(t, _field_is_variant(field))
+
+
+# Nested types are not cached: pyarrow compares and hashes them without the
+# metadata of their inner fields, so ARRAY(VARIANT) would equal ARRAY(BINARY).
+@functools.lru_cache(maxsize=1024)
+def _scalar_type_to_string(t: pa.DataType, is_variant: bool) -> str:
     if pa.types.is_boolean(t):
         return "BOOLEAN"
     elif pa.types.is_int8(t):
@@ -573,16 +1227,9 @@ def _field_type_to_string(field: pa.Field) -> str:
     elif pa.types.is_large_unicode(t) or pa.types.is_unicode(t):
         return "VARCHAR"
     elif pa.types.is_large_binary(t) or pa.types.is_binary(t):
-        if _field_is_variant(field):
+        if is_variant:
             return "VARIANT"
         else:
             return "BINARY"
-    elif pa.types.is_list(t):
-        return f"ARRAY({_inner_field_to_string(t.value_field)})"
-    elif pa.types.is_map(t):
-        return f"MAP({_inner_field_to_string(t.key_field)}, {_inner_field_to_string(t.item_field)})"
-    elif pa.types.is_struct(t):
-        args_str = ", ".join(_inner_field_to_string(field) for field in t)
-        return f"TUPLE({args_str})"
     else:
         raise ValueError(f"Unsupported type: {t}")
@@ -18,6 +18,9 @@ from decimal import Decimal
 import time
 from typing import List, Dict, Any, Tuple, Optional
 
+import pyarrow as pa
+import pyarrow.compute as pc
+
 from databend_udf import udf, UDFServer
 
 logging.basicConfig(level=logging.INFO)
@@ -72,6 +75,11 @@ def gcd_batch(x: list[int], y: list[int]) -> list[int]:
     return [gcd_single(x_i, y_i) for x_i, y_i in zip(x, y)]
 
 
+@udf(input_types=["BIGINT", "BIGINT"], result_type="BIGINT", arrow_mode=True)
+def multiply_arrow(x: pa.Array, y: pa.Array) -> pa.Array:
+    return pc.multiply(x, y)
+
+
 @udf(input_types=["VARCHAR", "VARCHAR", "VARCHAR"], result_type="VARCHAR")
 def split_and_join(s: str, split_s: str, join_s: str) -> str:
     return join_s.join(s.split(split_s))
@@ -321,6 +329,7 @@ if __name__ == "__main__":
     udf_server.add_function(bool_select)
     udf_server.add_function(gcd)
     udf_server.add_function(gcd_batch)
+    udf_server.add_function(multiply_arrow)
     udf_server.add_function(split_and_join)
     udf_server.add_function(decimal_div)
     udf_server.add_function(hex_to_dec)